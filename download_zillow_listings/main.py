@@ -1,21 +1,129 @@
 #!/usr/bin/env python
+import collections
 import datetime
+import math
+import os
 import pathlib
 import re
 import shutil
-import tempfile
+import threading
 import time
-from typing import Any, Iterable, List
-from urllib.parse import urlparse
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, List, Optional, OrderedDict, Set, Tuple
 
+from cachecontrol import CacheControlAdapter
+from cachecontrol.cache import BaseCache
 from loguru import logger
-from pywebcopy import save_webpage
+from pywebcopy.configs import ConfigHandler, get_config
+from pywebcopy.session import Session
 
 DOWNLOAD_DIR_ROOT = pathlib.Path(__file__).parents[1].joinpath("downloaded-webpages")
+_HTTP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_ZILLOW_URL_RE = re.compile(
+    r"^https?://(?:www\.)?zillow\.com/homedetails/([^/]+)/(\d+)_zpid"
+)
 
 
 def _is_folder_empty(folder: pathlib.Path) -> bool:
-    return list(folder.glob("*")) == []
+    return next(folder.iterdir(), None) is None
+
+
+class _LruCache(BaseCache):
+    """
+    In-memory ``cachecontrol`` cache that evicts the least recently used responses once
+    they take up more than ``max_bytes``.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self._max_bytes = max_bytes
+        self._num_bytes = 0
+        self._data = collections.OrderedDict()  # type: OrderedDict[str, bytes]
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, expires: Any = None) -> None:
+        with self._lock:
+            self._delete(key)
+            if len(value) > self._max_bytes:
+                return
+            self._data[key] = value
+            self._num_bytes += len(value)
+            while self._num_bytes > self._max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._num_bytes -= len(evicted)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._delete(key)
+
+    def _delete(self, key: str) -> None:
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._num_bytes -= len(value)
+
+
+_http_sessions = {}  # type: Dict[bool, Session]
+_http_sessions_lock = threading.Lock()
+
+
+def _get_http_session(config: ConfigHandler) -> Session:
+    """
+    Return an HTTP session shared by all downloads, so that connections to Zillow are
+    kept alive and reused instead of re-doing the TCP and TLS handshakes per listing.
+
+    The session is created from the first ``config`` passed in, so it sends the same
+    headers as the session ``pywebcopy`` would have created. Sessions that obey and
+    bypass robots.txt are cached separately.
+
+    Up to ``_HTTP_CACHE_MAX_BYTES`` of responses are cached in memory, so memory use
+    doesn't grow with the number of listings downloaded. Cached resources shared by
+    several listings, e.g. stylesheets and scripts, are revalidated with
+    ``If-None-Match`` and ``If-Modified-Since`` requests, so an unchanged resource is
+    only transferred once.
+    """
+    bypass_robots = bool(config.get("bypass_robots"))
+    with _http_sessions_lock:
+        if bypass_robots not in _http_sessions:
+            session = config.create_session()
+            adapter = CacheControlAdapter(
+                cache=_LruCache(_HTTP_CACHE_MAX_BYTES),
+                cache_etags=True,
+                pool_connections=4,
+                pool_maxsize=16,
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[bypass_robots] = session
+        return _http_sessions[bypass_robots]
+
+
+def _save_webpage(
+    url: str,
+    project_folder: str,
+    project_name: Optional[str] = None,
+    bypass_robots: Optional[bool] = None,
+    debug: bool = False,
+    open_in_browser: bool = True,
+    delay: Optional[float] = None,
+    threaded: Optional[bool] = None,
+) -> None:
+    """
+    Same as ``pywebcopy.save_webpage``, except the page is downloaded with the shared
+    session returned by ``_get_http_session``.
+    """
+    config = get_config(
+        url, project_folder, project_name, bypass_robots, debug, delay, threaded
+    )
+    page = config.create_page()
+    page.session = _get_http_session(config)
+    page.get(url)
+    page.save_complete(pop=open_in_browser and not threaded)
 
 
 def download_webpage(
@@ -57,7 +165,7 @@ def download_webpage(
             f"Cannot download to a non-empty directory, '{download_folder}'."
         )
     download_folder.mkdir(exist_ok=True, parents=True)
-    save_webpage(url, str(download_folder_abs_path), **kwargs)
+    _save_webpage(url, str(download_folder_abs_path), **kwargs)
 
 
 class ZillowUrl:
@@ -71,14 +179,26 @@ class ZillowUrl:
     https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-01234/12345678_zpid/
     """
 
+    __slots__ = ("_url", "_address", "_zpid", "_hash", "_rel_index_html")
+
     def __init__(self, url: str) -> None:
-        parsed_url = urlparse(url)
-        match_result = re.search(r"homedetails/(.*)/(\d+)_zpid", parsed_url.path)
+        match_result = _ZILLOW_URL_RE.match(url)
         if not match_result:
             raise ValueError(f"Invalid Zillow URL: {url}.")
-        self._url = parsed_url.geturl()
+        self._url = url
         self._address = match_result.group(1)
         self._zpid = int(match_result.group(2))
+        # Where pywebcopy saves the listing's index.html, relative to the download
+        # folder. See ``download_one_zillow_listing``.
+        self._rel_index_html = os.path.join(
+            "https_www.zillow.com",
+            "www.zillow.com",
+            "homedetails",
+            self._address,
+            f"{self._zpid}_zpid",
+            "index.html",
+        )
+        self._hash = hash((self._url, self._zpid, self._address, self.__class__))
 
     @property
     def url(self) -> str:
@@ -95,26 +215,23 @@ class ZillowUrl:
         """The eight-digit code that precedes the "_zpid" in the URL."""
         return self._zpid
 
+    @property
+    def rel_index_html(self) -> str:
+        """The path to index.html, relative to the listing's download folder."""
+        return self._rel_index_html
+
     def __hash__(self) -> int:
-        return hash(
-            (
-                self.url,
-                self.zpid,
-                self.address,
-                self.__class__,
-            )
-        )
+        return self._hash
 
     def __eq__(self, other: Any) -> bool:
         if not isinstance(other, self.__class__):
             return False
 
-        return all(
-            (
-                self.url == other.url,
-                self.zpid == other.zpid,
-                self.address == other.address,
-            )
+        # The zpid is the cheapest, most discriminating field to compare.
+        return (
+            self._zpid == other._zpid
+            and self._url == other._url
+            and self._address == other._address
         )
 
 
@@ -146,98 +263,215 @@ def download_one_zillow_listing(
     """
     download_dir.mkdir(exist_ok=True, parents=True)
     download_webpage(url.url, download_folder=download_dir)
-    downloaded_index_html_path = download_dir.joinpath(
-        "https_www.zillow.com",
-        "www.zillow.com",
-        "homedetails",
-        url.address,
-        f"{url.zpid}_zpid",
-        "index.html",
-    )
-    if not downloaded_index_html_path.exists():
+    downloaded_index_html_path = os.path.join(download_dir, url.rel_index_html)
+    if not os.path.exists(downloaded_index_html_path):
         raise MissingIndexHtml(
             f"Did not download index.html file at {downloaded_index_html_path}",
-            expected_index_html=downloaded_index_html_path,
+            expected_index_html=pathlib.Path(downloaded_index_html_path),
             url=url,
         )
-    return downloaded_index_html_path
+    return pathlib.Path(downloaded_index_html_path)
+
+
+class RateLimiter:
+    """
+    Token bucket that limits how often an action may happen, e.g. how often a
+    download may start. ``acquire`` blocks until a token is available.
+
+    :param rate:
+        Number of tokens added to the bucket per second. ``math.inf`` disables
+        rate limiting.
+    :param capacity:
+        Maximum number of tokens the bucket holds, i.e. the largest allowed burst.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancelled: Optional[threading.Event] = None) -> bool:
+        """
+        Take one token from the bucket, waiting for it to refill if necessary.
+
+        :param cancelled:
+            If this event is set before a token is taken, stop waiting.
+        :return:
+            ``True`` if a token was taken, ``False`` if ``cancelled`` was set.
+        """
+        while True:
+            if cancelled is not None and cancelled.is_set():
+                return False
+            if math.isinf(self._rate):
+                return True
+
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._last_refill) * self._rate,
+                )
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self._rate
+            if cancelled is None:
+                time.sleep(wait)
+            else:
+                cancelled.wait(wait)
+
+
+def _download_and_move_zillow_listing(
+    url: ZillowUrl,
+    download_dir_root: pathlib.Path,
+    rate_limiter: RateLimiter,
+    cancelled: threading.Event,
+) -> Optional[Tuple[ZillowUrl, pathlib.Path]]:
+    """
+    Download one Zillow listing to ``{download_dir_root}/{street address}.partial`` and
+    move its ``index.html`` to ``{download_dir_root}/{street address}``.
+
+    Both folders are on the same filesystem, so moving ``index.html`` is a rename rather
+    than a copy of the file's contents.
+
+    :return:
+        ``url`` and the path to the moved ``index.html`` file, or ``None`` if
+        ``cancelled`` was set before the download started.
+    """
+    partial_dir = download_dir_root.joinpath(f"{url.address}.partial")
+    # Remove leftovers of a previous, interrupted download.
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    try:
+        if not rate_limiter.acquire(cancelled):
+            return None
+        partial_index_html_path = download_one_zillow_listing(url, partial_dir)
+        listing_dir = download_dir_root.joinpath(url.address)
+        listing_dir.mkdir(parents=True)
+        return url, partial_index_html_path.rename(listing_dir.joinpath("index.html"))
+    finally:
+        shutil.rmtree(partial_dir, ignore_errors=True)
 
 
 def download_multiple_zillow_listings(
     urls: List[ZillowUrl],
     download_dir_root: pathlib.Path = DOWNLOAD_DIR_ROOT,
     interval_between_downloads: int = 3,
+    max_workers: int = 4,
 ) -> None:
     """
     Download Zillow listings.
 
     :param urls:
-        The urls to download.
+        The urls to download. If several urls have the same street address, only the
+        first one is downloaded.
     :param download_dir_root:
         The folder to download them to. See ``main`` function for a description of the
         resulting directory structure.
     :param interval_between_downloads:
-        Number of seconds to pause between downloads. Hopefully this prevents Zillow from rate-limiting
-        downloads.
+        Minimum number of seconds between the start of consecutive downloads. Hopefully
+        this prevents Zillow from rate-limiting downloads.
+    :param max_workers:
+        Maximum number of listings to download concurrently.
     """
-
+    rate_limiter = RateLimiter(
+        1 / interval_between_downloads if interval_between_downloads > 0 else math.inf
+    )
     error_urls = []  # type: List[MissingIndexHtml]
+    downloaded = []  # type: List[Tuple[str, pathlib.Path]]
+    # Two workers downloading the same listing would share its ``.partial`` folder.
+    unique_urls = {}  # type: Dict[str, ZillowUrl]
     for url in urls:
-        with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as tmpdir:
-            try:
-                tmp_index_html_path = download_one_zillow_listing(
-                    url, pathlib.Path(tmpdir)
+        unique_urls.setdefault(url.address, url)
+
+    def _collect_result(future: Future) -> None:
+        try:
+            result = future.result()
+        except MissingIndexHtml as exc:
+            error_urls.append(exc)
+        else:
+            if result is not None:
+                downloaded_url, index_html_path = result
+                downloaded.append(
+                    (
+                        downloaded_url.url,
+                        index_html_path.relative_to(download_dir_root.parent),
+                    )
                 )
-            except MissingIndexHtml as exc:
-                error_urls.append(exc)
-            else:
-                listing_dir = download_dir_root.joinpath(url.address)
-                listing_dir.mkdir(parents=True)
-                index_html_path = shutil.copy(tmp_index_html_path, listing_dir)
-                logger.info(
-                    "Downloaded {} to {}",
-                    url.url,
-                    pathlib.Path(index_html_path).relative_to(download_dir_root.parent),
-                )
-                time.sleep(interval_between_downloads)
 
-    if len(error_urls) > 0:
-        logger.error(
-            "The following URLs could not be downloaded: {}",
-            ", ".join(map(lambda err: err.url.address, error_urls)),
+    # Set on an unexpected error, so that workers waiting for the rate limiter don't
+    # start another download.
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    unread_futures = set()  # type: Set[Future]
+    try:
+        unread_futures.update(
+            executor.submit(
+                _download_and_move_zillow_listing,
+                url,
+                download_dir_root,
+                rate_limiter,
+                cancelled,
+            )
+            for url in unique_urls.values()
         )
+        for future in as_completed(list(unread_futures)):
+            unread_futures.discard(future)
+            _collect_result(future)
+    except BaseException:
+        # Stop at the first unexpected error (or Ctrl-C) instead of downloading the
+        # remaining listings before re-raising it.
+        cancelled.set()
+        executor.shutdown(cancel_futures=True)
+        raise
+    finally:
+        executor.shutdown()
+        # Downloads that were already running when an unexpected error was raised
+        # finish during ``shutdown``.
+        for future in unread_futures:
+            if future.cancelled():
+                continue
+            exc = future.exception()
+            if exc is None or isinstance(exc, MissingIndexHtml):
+                _collect_result(future)
+        # Log what was downloaded even if an unexpected error interrupted the downloads.
+        if downloaded:
+            logger.info(
+                "Downloaded {} listings: {}",
+                len(downloaded),
+                ", ".join(f"{url} to {path}" for url, path in downloaded),
+            )
+        if error_urls:
+            logger.error(
+                "The following URLs could not be downloaded: {}",
+                ", ".join(map(lambda err: err.url.address, error_urls)),
+            )
 
 
 def filter_urls(
     urls_to_filter: List[str], download_dir_root: pathlib.Path
 ) -> List[ZillowUrl]:
     """Remove urls that have already been downloaded to ``download_dir_root``."""
-    already_downloaded_folders = download_dir_root.glob("*")
-    already_downloaded_addresses = {
-        path.name.strip("/") for path in already_downloaded_folders if path.is_dir()
-    }
-    parsed_urls = {ZillowUrl(url) for url in urls_to_filter}
-    map_street_address_to_url = {url.address: url for url in parsed_urls}
-    urls_not_already_downloaded = set(map_street_address_to_url).difference(
-        already_downloaded_addresses
-    )
-    return [
-        map_street_address_to_url[address] for address in urls_not_already_downloaded
-    ]
+    # Look up each listing's folder instead of listing every folder in
+    # ``download_dir_root``, so that memory use doesn't grow with the number of
+    # listings that have already been downloaded.
+    seen_addresses = set()
+    urls_not_already_downloaded = []  # type: List[ZillowUrl]
+    for url in map(ZillowUrl, urls_to_filter):
+        if url.address in seen_addresses:
+            continue
+        seen_addresses.add(url.address)
+        if not os.path.isdir(os.path.join(download_dir_root, url.address)):
+            urls_not_already_downloaded.append(url)
+    return urls_not_already_downloaded
 
 
 def configure_logging(log_dir_root: pathlib.Path) -> None:
     now = datetime.datetime.now()
-    log_file = log_dir_root.joinpath(
-        str(now.year),
-        str(now.month),
-        str(now.day),
-        str(now.hour),
-        str(now.minute),
-        str(now.second),
-        "log.log",
-    )
-    log_file.parent.mkdir(parents=True, exist_ok=True)
+    log_file = log_dir_root.joinpath(f"{now:%Y%m%dT%H%M%S}.log")
+    log_dir_root.mkdir(parents=True, exist_ok=True)
     logger.add(log_file, level="TRACE")
     logger.info("Logging configured. Logs will be written to stderr and {}", log_file)
 
@@ -1,18 +1,187 @@
-import itertools
+import http.server
+import math
 import pathlib
-import shutil
+import threading
+import time
 
 import pytest
+import pywebcopy.configs
+import requests
+from cachecontrol import CacheControlAdapter
 
 from download_zillow_listings.main import (
     MissingIndexHtml,
+    RateLimiter,
     ZillowUrl,
+    _get_http_session,
+    _LruCache,
     download_multiple_zillow_listings,
     download_one_zillow_listing,
+    download_webpage,
     filter_urls,
 )
 
 
+class TestDownloadWebpage:
+    @classmethod
+    @pytest.fixture(scope="function", autouse=True, name="no_cached_http_sessions")
+    def fixture_no_cached_http_sessions(cls, mocker) -> None:
+        """Start each test without any HTTP sessions cached by earlier tests."""
+        mocker.patch.dict("download_zillow_listings.main._http_sessions", clear=True)
+
+    @staticmethod
+    def test_session_is_reused(tmp_path: pathlib.Path, mocker) -> None:
+        """
+        Assert that consecutive downloads use the same HTTP session, so that connections
+        to the server are reused, and that it sends the headers configured in
+        ``pywebcopy``.
+        """
+        # Arrange
+        mock_get = mocker.patch("pywebcopy.core.WebPage.get", autospec=True)
+        mock_save_complete = mocker.patch(
+            "pywebcopy.core.WebPage.save_complete", autospec=True
+        )
+        url = "https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
+
+        # Act
+        download_webpage(url, tmp_path.joinpath("0"))
+        download_webpage(url, tmp_path.joinpath("1"))
+
+        # Assert
+        pages = [call.args[0] for call in mock_get.call_args_list]
+        assert len(pages) == 2
+        assert pages[0].session is pages[1].session
+        assert isinstance(
+            pages[0].session.get_adapter("https://www.zillow.com"),
+            CacheControlAdapter,
+        )
+        request = pages[0].session.prepare_request(requests.Request("GET", url))
+        assert (
+            request.headers["User-Agent"]
+            == pywebcopy.configs.default_config["http_headers"]["User-Agent"]
+        )
+        assert "Accept-Language" in request.headers
+        for page in pages:
+            mock_get.assert_any_call(page, url)
+        assert mock_save_complete.call_count == 2
+
+    @staticmethod
+    def test_unchanged_resource_is_served_from_cache(tmp_path: pathlib.Path) -> None:
+        """
+        Assert that a resource is revalidated with ``If-None-Match`` when it is requested
+        again, and that the server's 304 response is answered from the cache.
+        """
+        # Arrange
+        body = b"<html>listing</html>"
+        etag = '"abc123"'
+        received_if_none_match = []
+
+        class _Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                received_if_none_match.append(self.headers.get("If-None-Match"))
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        url = f"http://127.0.0.1:{server.server_port}/listing"
+        session = _get_http_session(
+            pywebcopy.configs.get_config(url, str(tmp_path), bypass_robots=True)
+        )
+
+        # Act
+        try:
+            first_response = session.get(url)
+            second_response = session.get(url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Assert
+        assert received_if_none_match == [None, etag]
+        assert first_response.content == body
+        assert second_response.status_code == 200
+        assert second_response.content == body
+
+
+class TestLruCache:
+    @staticmethod
+    def test_least_recently_used_is_evicted() -> None:
+        """
+        Assert that the least recently used values are evicted once the cache holds
+        more than ``max_bytes``.
+        """
+        # Arrange
+        cache = _LruCache(max_bytes=10)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        cache.get("a")
+
+        # Act
+        cache.set("c", b"1234")
+
+        # Assert
+        assert cache.get("a") == b"1234"
+        assert cache.get("b") is None
+        assert cache.get("c") == b"1234"
+
+    @staticmethod
+    def test_value_larger_than_cache() -> None:
+        """Assert that a value larger than ``max_bytes`` isn't cached."""
+        # Arrange
+        cache = _LruCache(max_bytes=10)
+
+        # Act
+        cache.set("a", b"12345678901")
+
+        # Assert
+        assert cache.get("a") is None
+
+
+class TestZillowUrl:
+    @staticmethod
+    def test_simple() -> None:
+        """Assert that the street address and zpid are parsed out of a listing URL."""
+        # No arrange
+        # Act
+        result = ZillowUrl(
+            "https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
+        )
+
+        # Assert
+        assert result.address == "123-Fake-St-Emerald-City-MO-12345"
+        assert result.zpid == 87654321
+
+    @staticmethod
+    @pytest.mark.parametrize(
+        "url",
+        [
+            "https://www.zillow.com/",
+            "https://www.zillow.com/homes/homedetails/123-Fake-St/87654321_zpid/",
+            "https://www.zillow.com/homedetails/123-Fake-St/Apt-1/87654321_zpid/",
+            "https://www.example.com/homedetails/123-Fake-St/87654321_zpid/",
+        ],
+    )
+    def test_invalid_url(url: str) -> None:
+        """Assert that URLs that aren't Zillow listings raise ``ValueError``."""
+        # No arrange
+        # Act and assert
+        with pytest.raises(ValueError):
+            ZillowUrl(url)
+
+
 class TestFilterUrls:
     @staticmethod
     def test_simple(tmp_path: pathlib.Path) -> None:
@@ -48,6 +217,42 @@ class TestFilterUrls:
         # Assert
         assert result == []
 
+    @staticmethod
+    def test_order_is_preserved_and_duplicates_removed(tmp_path: pathlib.Path) -> None:
+        """
+        Assert that urls are returned in the order they were given, and that a listing
+        passed more than once is only returned once.
+        """
+        # Arrange
+        urls_under_test = [
+            "https://www.zillow.com/homedetails/LOT-Fake-St-Paradise-City-MA-01234/87654321_zpid/",
+            "https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-01234/12345678_zpid/",
+            "https://www.zillow.com/homedetails/LOT-Fake-St-Paradise-City-MA-01234/87654321_zpid/",
+        ]
+
+        # Act
+        result = filter_urls(urls_under_test, tmp_path)
+
+        # Assert
+        assert result == [ZillowUrl(url) for url in urls_under_test[:2]]
+
+    @staticmethod
+    def test_download_dir_root_does_not_exist(tmp_path: pathlib.Path) -> None:
+        """
+        Assert that no urls are filtered out if ``download_dir_root`` has not been
+        created yet.
+        """
+        # Arrange
+        urls_under_test = [
+            "https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-01234/12345678_zpid/",
+        ]
+
+        # Act
+        result = filter_urls(urls_under_test, tmp_path.joinpath("does-not-exist"))
+
+        # Assert
+        assert result == [ZillowUrl(urls_under_test[0])]
+
 
 class TestDownloadOneZillowListing:
     @staticmethod
@@ -125,50 +330,25 @@ class TestDownloadOneZillowListing:
 
 
 class TestDownloadMultipleZillowListings:
-    @classmethod
-    @pytest.fixture(scope="function", name="empty_dir")
-    def fixture_empty_dir(cls, tmp_path: pathlib.Path) -> pathlib.Path:
-        """
-        Return a temporary directory and delete its contents after the test exits.
-
-        Use this to replace ``tempfile.TemporaryDirectory``, which creates an empty
-        directory. The advantage of this fixture is its path is deterministic.
-        """
-        yield tmp_path
-        shutil.rmtree(tmp_path, ignore_errors=False)
-
     @staticmethod
-    def test_download_one_listing(mocker, empty_dir: pathlib.Path) -> None:
+    def _mock_download_one_zillow_listing(url, download_dir) -> pathlib.Path:
+        fake_downloaded_listing = download_dir.joinpath("index.html")
+        download_dir.mkdir(parents=True)
+        fake_downloaded_listing.touch()
+        return fake_downloaded_listing
+
+    @classmethod
+    def test_download_one_listing(cls, mocker, tmp_path: pathlib.Path) -> None:
         """
         Given a list of one Zillow listing, assert that the expected index.html
-        file is downloaded.
+        file is downloaded, and that the partially downloaded listing is removed.
         """
 
         # Arrange
-        tmp_download_dir = empty_dir.joinpath("tmp_download_dir")
-        dst_dir_for_index_html = empty_dir.joinpath("dst")
-
-        def _mock_TemporaryDirectory_enter() -> str:
-            tmp_download_dir.mkdir(parents=True)
-            return str(tmp_download_dir)
-
-        # Mock the ``tempfile.TemporaryDirectory`` context manager
-        mock_temporary_directory = mocker.patch(
-            "download_zillow_listings.main.tempfile.TemporaryDirectory"
-        )
-        mock_temporary_directory.return_value.__enter__ = mocker.MagicMock(
-            side_effect=_mock_TemporaryDirectory_enter
-        )
-
-        def _mock_download_one_zillow_listing(url, download_dir) -> pathlib.Path:
-            fake_downloaded_listing = download_dir.joinpath("index.html")
-            # ``tmp_download_dir`` should already be created.
-            fake_downloaded_listing.touch()
-            return fake_downloaded_listing
-
+        dst_dir_for_index_html = tmp_path.joinpath("dst")
         mock_download_one_zillow_listing = mocker.patch(
             "download_zillow_listings.main.download_one_zillow_listing",
-            side_effect=_mock_download_one_zillow_listing,
+            side_effect=cls._mock_download_one_zillow_listing,
         )
 
         url_to_download = ZillowUrl(
@@ -184,44 +364,28 @@ class TestDownloadMultipleZillowListings:
 
         # Assert
         mock_download_one_zillow_listing.assert_called_once_with(
-            url_to_download, tmp_download_dir
+            url_to_download,
+            dst_dir_for_index_html.joinpath(
+                "123-Fake-St-Emerald-City-MO-12345.partial"
+            ),
         )
         assert dst_dir_for_index_html.joinpath(
             "123-Fake-St-Emerald-City-MO-12345", "index.html"
         ).exists()
+        assert [path.name for path in dst_dir_for_index_html.iterdir()] == [
+            "123-Fake-St-Emerald-City-MO-12345"
+        ]
 
-    @staticmethod
-    def test_multiple_listings(mocker, empty_dir: pathlib.Path) -> None:
+    @classmethod
+    def test_multiple_listings(cls, mocker, tmp_path: pathlib.Path) -> None:
         """
         Given multiple listings to download, assert that they are in fact downloaded.
         """
 
         # Arrange
-        tmp_download_dir = empty_dir.joinpath("tmp_download_dir")
-        tmp_dir_counter = itertools.count()
-
-        def _mock_TemporaryDirectory_enter() -> str:
-            _tmp_download_dir = tmp_download_dir.joinpath(str(next(tmp_dir_counter)))
-            _tmp_download_dir.mkdir(parents=True)
-            return str(_tmp_download_dir)
-
-        # Mock the ``tempfile.TemporaryDirectory`` context manager
-        mock_temporary_directory = mocker.patch(
-            "download_zillow_listings.main.tempfile.TemporaryDirectory"
-        )
-        mock_temporary_directory.return_value.__enter__ = mocker.MagicMock(
-            side_effect=_mock_TemporaryDirectory_enter
-        )
-
-        def _mock_download_one_zillow_listing(url, download_dir) -> pathlib.Path:
-            fake_downloaded_listing = download_dir.joinpath("index.html")
-            # ``tmp_download_dir`` should already be created.
-            fake_downloaded_listing.touch()
-            return fake_downloaded_listing
-
         mock_download_one_zillow_listing = mocker.patch(
             "download_zillow_listings.main.download_one_zillow_listing",
-            side_effect=_mock_download_one_zillow_listing,
+            side_effect=cls._mock_download_one_zillow_listing,
         )
 
         urls_to_download = [
@@ -232,7 +396,7 @@ class TestDownloadMultipleZillowListings:
                 "https://www.zillow.com/homedetails/LOT-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
             ),
         ]
-        dst_dir_for_index_html = empty_dir.joinpath("dst")
+        dst_dir_for_index_html = tmp_path.joinpath("dst")
 
         # Act
         download_multiple_zillow_listings(
@@ -242,11 +406,15 @@ class TestDownloadMultipleZillowListings:
         )
 
         # Assert
+        # Listings are downloaded concurrently, so the calls may be in any order.
         mock_download_one_zillow_listing.assert_has_calls(
             [
-                mocker.call(urls_to_download[0], tmp_download_dir.joinpath("0")),
-                mocker.call(urls_to_download[1], tmp_download_dir.joinpath("1")),
-            ]
+                mocker.call(
+                    url, dst_dir_for_index_html.joinpath(f"{url.address}.partial")
+                )
+                for url in urls_to_download
+            ],
+            any_order=True,
         )
         assert dst_dir_for_index_html.joinpath(
             "123-Fake-St-Emerald-City-MO-12345", "index.html"
@@ -254,3 +422,271 @@ class TestDownloadMultipleZillowListings:
         assert dst_dir_for_index_html.joinpath(
             "LOT-Fake-St-Emerald-City-MO-12345", "index.html"
         ).exists()
+
+    @staticmethod
+    def test_download_fails(mocker, tmp_path: pathlib.Path) -> None:
+        """
+        Assert that a listing whose index.html wasn't downloaded leaves no folders
+        behind in ``download_dir_root``.
+        """
+
+        # Arrange
+        url_to_download = ZillowUrl(
+            "https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
+        )
+        dst_dir_for_index_html = tmp_path.joinpath("dst")
+        partial_dir = dst_dir_for_index_html.joinpath(
+            "123-Fake-St-Emerald-City-MO-12345.partial"
+        )
+
+        def _mock_download_one_zillow_listing(url, download_dir) -> pathlib.Path:
+            download_dir.mkdir(parents=True)
+            raise MissingIndexHtml(
+                expected_index_html=download_dir.joinpath("index.html"), url=url
+            )
+
+        mocker.patch(
+            "download_zillow_listings.main.download_one_zillow_listing",
+            side_effect=_mock_download_one_zillow_listing,
+        )
+
+        # Act
+        download_multiple_zillow_listings(
+            [url_to_download],
+            download_dir_root=dst_dir_for_index_html,
+            interval_between_downloads=0,
+        )
+
+        # Assert
+        assert not partial_dir.exists()
+        assert not dst_dir_for_index_html.joinpath(
+            "123-Fake-St-Emerald-City-MO-12345"
+        ).exists()
+
+    @staticmethod
+    def test_unexpected_error_cancels_remaining_downloads(
+        mocker, tmp_path: pathlib.Path
+    ) -> None:
+        """
+        Assert that an error other than ``MissingIndexHtml`` is raised without first
+        downloading the rest of the listings.
+        """
+
+        # Arrange
+        urls_to_download = [
+            ZillowUrl(
+                f"https://www.zillow.com/homedetails/{i}-Fake-St-Emerald-City-MO-12345/8765432{i}_zpid/"
+            )
+            for i in range(6)
+        ]
+
+        def _mock_download_one_zillow_listing(url, download_dir) -> pathlib.Path:
+            if url == urls_to_download[0]:
+                raise ConnectionError
+            # Simulate network latency, so that the first download's error is handled
+            # while the second download is still in progress.
+            time.sleep(0.1)
+            return TestDownloadMultipleZillowListings._mock_download_one_zillow_listing(
+                url, download_dir
+            )
+
+        mock_download_one_zillow_listing = mocker.patch(
+            "download_zillow_listings.main.download_one_zillow_listing",
+            side_effect=_mock_download_one_zillow_listing,
+        )
+
+        # Act and assert
+        with pytest.raises(ConnectionError):
+            download_multiple_zillow_listings(
+                urls_to_download,
+                download_dir_root=tmp_path.joinpath("dst"),
+                interval_between_downloads=0,
+                max_workers=1,
+            )
+
+        # The worker may have started the second download before the first one's
+        # error was handled, but no more than that.
+        assert mock_download_one_zillow_listing.call_count <= 2
+
+    @staticmethod
+    def test_unexpected_error_stops_rate_limited_workers(
+        mocker, tmp_path: pathlib.Path
+    ) -> None:
+        """
+        Assert that workers waiting for the rate limiter when an unexpected error is
+        raised don't start another download.
+        """
+
+        # Arrange
+        urls_to_download = [
+            ZillowUrl(
+                f"https://www.zillow.com/homedetails/{i}-Fake-St-Emerald-City-MO-12345/8765432{i}_zpid/"
+            )
+            for i in range(6)
+        ]
+        dst_dir_for_index_html = tmp_path.joinpath("dst")
+        mock_download_one_zillow_listing = mocker.patch(
+            "download_zillow_listings.main.download_one_zillow_listing",
+            side_effect=ConnectionError,
+        )
+
+        # Act
+        start = time.monotonic()
+        with pytest.raises(ConnectionError):
+            download_multiple_zillow_listings(
+                urls_to_download,
+                download_dir_root=dst_dir_for_index_html,
+                interval_between_downloads=5,
+                max_workers=4,
+            )
+        elapsed = time.monotonic() - start
+
+        # Assert
+        mock_download_one_zillow_listing.assert_called_once()
+        assert elapsed < 5
+
+    @classmethod
+    def test_downloads_are_logged_after_unexpected_error(
+        cls, mocker, tmp_path: pathlib.Path
+    ) -> None:
+        """
+        Assert that listings downloaded before an unexpected error, or still being
+        downloaded when it was raised, are logged along with their urls.
+        """
+
+        # Arrange
+        urls_to_download = [
+            ZillowUrl(
+                "https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
+            ),
+            ZillowUrl(
+                "https://www.zillow.com/homedetails/LOT-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
+            ),
+            ZillowUrl(
+                "https://www.zillow.com/homedetails/456-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
+            ),
+        ]
+        dst_dir_for_index_html = tmp_path.joinpath("dst")
+
+        def _mock_download_one_zillow_listing(url, download_dir) -> pathlib.Path:
+            if url == urls_to_download[2]:
+                raise ConnectionError
+            if url == urls_to_download[1]:
+                # Still downloading when the error is raised.
+                time.sleep(0.2)
+            return cls._mock_download_one_zillow_listing(url, download_dir)
+
+        mocker.patch(
+            "download_zillow_listings.main.download_one_zillow_listing",
+            side_effect=_mock_download_one_zillow_listing,
+        )
+        mock_logger = mocker.patch("download_zillow_listings.main.logger")
+
+        # Act
+        with pytest.raises(ConnectionError):
+            download_multiple_zillow_listings(
+                urls_to_download,
+                download_dir_root=dst_dir_for_index_html,
+                interval_between_downloads=0,
+                max_workers=2,
+            )
+
+        # Assert
+        mock_logger.info.assert_called_once()
+        message, num_downloaded, downloaded = mock_logger.info.call_args.args
+        assert message == "Downloaded {} listings: {}"
+        assert num_downloaded == 2
+        for url in urls_to_download[:2]:
+            assert dst_dir_for_index_html.joinpath(url.address, "index.html").exists()
+            assert (
+                f"{url.url} to " + str(pathlib.Path("dst", url.address, "index.html"))
+                in downloaded
+            )
+
+    @classmethod
+    def test_duplicate_urls(cls, mocker, tmp_path: pathlib.Path) -> None:
+        """Assert that a listing passed more than once is downloaded once."""
+
+        # Arrange
+        url_to_download = ZillowUrl(
+            "https://www.zillow.com/homedetails/123-Fake-St-Emerald-City-MO-12345/87654321_zpid/"
+        )
+        mock_download_one_zillow_listing = mocker.patch(
+            "download_zillow_listings.main.download_one_zillow_listing",
+            side_effect=cls._mock_download_one_zillow_listing,
+        )
+
+        # Act
+        download_multiple_zillow_listings(
+            [url_to_download, url_to_download],
+            download_dir_root=tmp_path.joinpath("dst"),
+            interval_between_downloads=0,
+        )
+
+        # Assert
+        assert mock_download_one_zillow_listing.call_count == 1
+
+
+class TestRateLimiter:
+    @staticmethod
+    def test_waits_for_bucket_to_refill(mocker) -> None:
+        """
+        Assert that ``acquire`` returns immediately while the bucket has a token, and
+        otherwise sleeps until one has been refilled.
+        """
+        # Arrange
+        clock = [0.0]
+
+        def _mock_sleep(seconds: float) -> None:
+            clock[0] += seconds
+
+        mocker.patch(
+            "download_zillow_listings.main.time.monotonic",
+            side_effect=lambda: clock[0],
+        )
+        mock_sleep = mocker.patch(
+            "download_zillow_listings.main.time.sleep", side_effect=_mock_sleep
+        )
+        rate_limiter = RateLimiter(rate=0.5)
+
+        # Act
+        rate_limiter.acquire()
+        rate_limiter.acquire()
+
+        # Assert
+        mock_sleep.assert_called_once_with(2.0)
+        assert clock[0] == 2.0
+
+    @staticmethod
+    def test_cancelled(mocker) -> None:
+        """
+        Assert that ``acquire`` stops waiting and returns ``False`` once ``cancelled``
+        is set.
+        """
+        # Arrange
+        mock_sleep = mocker.patch("download_zillow_listings.main.time.sleep")
+        rate_limiter = RateLimiter(rate=0.5)
+        cancelled = threading.Event()
+        assert rate_limiter.acquire(cancelled)
+        cancelled.set()
+
+        # Act
+        result = rate_limiter.acquire(cancelled)
+
+        # Assert
+        assert result is False
+        mock_sleep.assert_not_called()
+
+    @staticmethod
+    def test_infinite_rate(mocker) -> None:
+        """Assert that ``acquire`` never sleeps when the rate is infinite."""
+        # Arrange
+        mock_sleep = mocker.patch("download_zillow_listings.main.time.sleep")
+        rate_limiter = RateLimiter(rate=math.inf)
+
+        # Act
+        for _ in range(3):
+            rate_limiter.acquire()
+
+        # Assert
+        mock_sleep.assert_not_called()